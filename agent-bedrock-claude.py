@@ -5,6 +5,17 @@ import docx  # For handling DOCX files
 from PyPDF2 import PdfReader  # For handling PDF files
 import re
 import json
+import os
+import time
+import cProfile
+import tracemalloc
+import functools
+import contextlib
+import threading
+import zlib
+import tempfile
+import zipfile
+import numpy as np
 from botocore.exceptions import ClientError
 
 
@@ -15,6 +26,19 @@ AGENT_ID = "QC79LBL2C1"
 AGENT_ALIAS_ID = "K7MTXRNYQU"  # v3: "TRWVSCKGXA", v5: "EXXPUSCFYP", v6: "K7MTXRNYQU"
 MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
 # MODEL_ID = "anthropic.claude-3-haiku-20240307-v1:0"
+PROFILE_DIR = os.environ.get("RFP_PROFILE_DIR", "profiles")
+PROFILE_MODES = ["timers", "cprofile", "tracemalloc"]
+ANSWER_LIBRARY_DIR = os.environ.get("RFP_ANSWER_LIBRARY_DIR", "answer_library")
+ANSWER_LIBRARY_DIM = 1024
+# Similar questions are only offered as drafts; the vectors cannot tell numbers or
+# negations apart, so answers are reused without the agent only on an exact match
+ANSWER_DRAFT_THRESHOLD = 0.5
+ANSWER_LIBRARY_LOCK_TIMEOUT = 30  # Seconds before a lock file is treated as stale
+ANSWER_STOP_WORDS = {
+    "a", "an", "and", "any", "are", "by", "describe", "do", "does", "for",
+    "has", "have", "how", "in", "is", "its", "of", "on", "or", "please",
+    "provide", "s", "the", "to", "what", "with", "blocpower",
+}
 
 # Setup bedrock client
 bedrock_agent_runtime = boto3.client(
@@ -27,6 +51,196 @@ bedrock_runtime = boto3.client(
 )
 
 
+def get_profile_mode():
+    # Profiling is opt-in: ?profile=<mode> in the URL or RFP_PROFILE=<mode> in the environment
+    mode = st.query_params.get("profile") or os.environ.get("RFP_PROFILE", "")
+    mode = mode.lower()
+    if mode in ["1", "true", "yes"]:
+        return "timers"
+    if mode in PROFILE_MODES:
+        return mode
+    return None
+
+
+# The script re-executes on every rerun, so this state is fresh for each one
+profile_mode = get_profile_mode()
+rerun_profile = {
+    "start": None,
+    "timings": [],
+    "profiler": None,
+    "capture": None,
+    "skipped": False,
+}
+
+
+@contextlib.contextmanager
+def profile_stage(stage):
+    if profile_mode is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        rerun_profile["timings"].append((stage, time.perf_counter() - start))
+
+
+def profiled(stage):
+    # Leave the function untouched when profiling is off so there is no overhead
+    def decorator(func):
+        if profile_mode is None:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with profile_stage(stage):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@st.cache_resource
+def get_profile_capture_lock():
+    # Shared by all sessions because cProfile and tracemalloc are process-wide
+    return threading.Lock()
+
+
+def start_rerun_profile():
+    if profile_mode is None:
+        return
+    if "profile_session_id" not in st.session_state:
+        st.session_state.profile_session_id = generate_random_15digit()
+        st.session_state.profile_rerun_count = 0
+    st.session_state.profile_rerun_count += 1
+    rerun_profile["start"] = time.perf_counter()
+    rerun_profile["capture"] = None
+    rerun_profile["skipped"] = False
+    if profile_mode not in ["cprofile", "tracemalloc"]:
+        return
+
+    # Only one session can capture at a time; the others fall back to timers
+    lock = get_profile_capture_lock()
+    if not lock.acquire(blocking=False):
+        rerun_profile["skipped"] = True
+        return
+    if profile_mode == "cprofile":
+        rerun_profile["profiler"] = cProfile.Profile()
+        try:
+            rerun_profile["profiler"].enable()
+        except ValueError:
+            # Python 3.12+ refuses to start while another profiler (e.g. a debugger) is active
+            lock.release()
+            rerun_profile["skipped"] = True
+            return
+    elif tracemalloc.is_tracing():
+        # Tracing was started outside this app (e.g. PYTHONTRACEMALLOC), leave it alone
+        lock.release()
+        rerun_profile["skipped"] = True
+        return
+    else:
+        tracemalloc.start()
+    rerun_profile["capture"] = profile_mode
+
+
+def stop_rerun_capture():
+    # Always stop tracing and release the lock before anything touches the disk
+    snapshot = None
+    peak_memory = None
+    try:
+        if rerun_profile["capture"] == "tracemalloc":
+            snapshot = tracemalloc.take_snapshot()
+            _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        if rerun_profile["capture"] == "cprofile":
+            rerun_profile["profiler"].disable()
+        elif rerun_profile["capture"] == "tracemalloc" and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        if rerun_profile["capture"] is not None:
+            rerun_profile["capture"] = None
+            get_profile_capture_lock().release()
+    return snapshot, peak_memory
+
+
+def finish_rerun_profile():
+    if profile_mode is None or rerun_profile["start"] is None:
+        return
+    total = time.perf_counter() - rerun_profile["start"]
+    capture = rerun_profile["capture"]
+    snapshot, peak_memory = stop_rerun_capture()
+    now = time.time()
+    timestamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(now))
+    milliseconds = int(now * 1000) % 1000
+    base_path = os.path.join(
+        PROFILE_DIR,
+        f"rerun-{st.session_state.profile_session_id}-"
+        f"{st.session_state.profile_rerun_count:04d}-{timestamp}-{milliseconds:03d}",
+    )
+
+    # Aggregate the stage timings, keeping the order in which stages first ran
+    breakdown = {}
+    for stage, seconds in rerun_profile["timings"]:
+        entry = breakdown.setdefault(
+            stage, {"stage": stage, "calls": 0, "total_ms": 0.0}
+        )
+        entry["calls"] += 1
+        entry["total_ms"] += seconds * 1000
+    summary = {
+        "mode": profile_mode,
+        "capture_skipped": rerun_profile["skipped"],
+        "rerun_ms": total * 1000,
+        "peak_memory_bytes": peak_memory,
+        "stages": list(breakdown.values()),
+    }
+
+    # Writing the dumps must never break the rerun being profiled
+    saved_files = []
+    save_error = None
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        # Dump the raw profile for offline analysis (e.g. snakeviz, flameprof)
+        if capture == "cprofile":
+            rerun_profile["profiler"].dump_stats(base_path + ".prof")
+            saved_files.append(base_path + ".prof")
+        elif snapshot is not None:
+            snapshot.dump(base_path + ".tracemalloc")
+            saved_files.append(base_path + ".tracemalloc")
+        with open(base_path + ".json", "w") as f:
+            json.dump(summary, f, indent=4)
+        saved_files.append(base_path + ".json")
+    except OSError as e:
+        save_error = e
+
+    with st.sidebar:
+        st.subheader("Profiling")
+        st.caption(f"Mode: {profile_mode}. Stages may be nested.")
+        if rerun_profile["skipped"]:
+            st.caption(
+                f"{profile_mode} capture skipped: it is already running elsewhere in this process."
+            )
+        st.markdown(f"**Rerun total:** {summary['rerun_ms']:.1f} ms")
+        if summary["stages"]:
+            st.table(
+                [
+                    {
+                        "stage": entry["stage"],
+                        "calls": entry["calls"],
+                        "total (ms)": round(entry["total_ms"], 1),
+                    }
+                    for entry in summary["stages"]
+                ]
+            )
+        if peak_memory is not None:
+            st.markdown(
+                f"**Peak traced memory:** {peak_memory / 1024 / 1024:.2f} MiB"
+            )
+        for path in saved_files:
+            st.caption(f"Saved {path}")
+        if save_error is not None:
+            st.warning(f"Could not save profile to {PROFILE_DIR}: {save_error}")
+
+
 def generate_random_15digit():
     return "".join(str(random.randint(0, 9)) for _ in range(15))
 
@@ -42,6 +256,7 @@ def process_stream(stream):
     return output
 
 
+@profiled("invoke (agent)")
 def invoke_agent(query):
     # Check if a session ID already exists, if not, create one
     if "session_id" not in st.session_state:
@@ -78,6 +293,7 @@ def invoke_agent(query):
 
 
 
+@profiled("invoke (model)")
 def invoke_model(prompt,  max_tokens=30000, temperature=0.5):
     # Format the request payload using the model's native structure.
     native_request = {
@@ -124,6 +340,7 @@ def upload_file(file):
     return context
 
 
+@profiled("parse")
 def read_file(file, file_type):
     if file_type == "pdf":
         try:
@@ -143,256 +360,468 @@ def read_file(file, file_type):
             return ""
 
 
+@profiled("extract")
 def extract_questions(text):
     pattern = r"\d+\.\s(.*?)\s*$"
     questions = re.findall(pattern, text, re.MULTILINE)
     return questions
 
 
-# Streamlit UI
-st.set_page_config(page_title="AWS Bedrock Chatbot", page_icon=":robot_face:")
+def embed_question(question):
+    # Hashed bag of words, word bigrams and character trigrams, L2-normalized
+    vector = np.zeros(ANSWER_LIBRARY_DIM, dtype=np.float32)
+    words = [
+        word
+        for word in re.findall(r"[a-z0-9]+", question.lower())
+        if word not in ANSWER_STOP_WORDS
+    ]
+    features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    for word in words:
+        padded = f"#{word}#"
+        features += [padded[i : i + 3] for i in range(len(padded) - 2)]
+    for feature in features:
+        # crc32 rather than hash() so vectors are stable across processes
+        vector[zlib.crc32(feature.encode("utf-8")) % ANSWER_LIBRARY_DIM] += 1.0
+    norm = np.linalg.norm(vector)
+    if norm > 0:
+        vector /= norm
+    return vector
+
+
+def normalize_question(question):
+    return " ".join(re.findall(r"[a-z0-9]+", question.lower()))
+
+
+def empty_answer_library():
+    return {
+        "entries": [],
+        "vectors": np.zeros((0, ANSWER_LIBRARY_DIM), dtype=np.float32),
+        "rows": {},
+    }
 
-# Add logo
-st.image("logo.png", width=200)  # Replace "logo.png" with your image file or URL
-
-st.title("RFP Engine")
-
-
-# Initialize session state for chat history
-if "chat_history" not in st.session_state:
-    st.session_state.chat_history = []
-if "state" not in st.session_state:
-    st.session_state.state = 1
-if "last_state" not in st.session_state:
-    st.session_state.last_state = 0
-if "question_list" not in st.session_state:
-    st.session_state.question_list = []
-if "program_name" not in st.session_state:
-    st.session_state.program_name = ""
-if "response" not in st.session_state:
-    st.session_state.response = ""
-
-st.markdown(
-    """
-    **Enter your question/answer:**
-
-    - First, tell me the agency and the program hosting the RFP to which we need to respond.
-    - Then, follow up with any additional information or questions you have.
-    """
-)
 
-query = st.text_input("Your input:")
-file = st.file_uploader(
-    f"Upload your document:", type=["pdf", "docx"], key="file_uploader"
-)
+def load_answer_library():
+    library_path = os.path.join(ANSWER_LIBRARY_DIR, "library.npz")
+    if not os.path.exists(library_path):
+        return empty_answer_library()
+    # A damaged or partly copied file is reported as ValueError like a mismatch
+    try:
+        with np.load(library_path) as data:
+            entries = json.loads(str(data["entries"]))
+            vectors = data["vectors"]
+    except (OSError, EOFError, KeyError, zipfile.BadZipFile) as e:
+        raise ValueError(f"{library_path} could not be read: {e}") from e
+    if vectors.shape != (len(entries), ANSWER_LIBRARY_DIM):
+        raise ValueError(
+            f"{library_path} has {len(entries)} entries but vectors of shape {vectors.shape}"
+        )
+    # Exact lookups go through this index, not the nearest neighbour
+    rows = {
+        normalize_question(entry["question"]): index
+        for index, entry in enumerate(entries)
+    }
+    return {"entries": entries, "vectors": vectors, "rows": rows}
 
-if st.button("Submit", key="submit_query"):
-    if query or file:
-        with st.spinner("Processing..."):
-            response_text = ""
-            citations = []
-
-            # State 1: Provide information on progarm
-            if st.session_state.state == 1:
-                st.session_state.program_name = query
-                user_command = f"Use Internet Search to provide information on {st.session_state.program_name}."
-                # response_text, citations = invoke_agent(user_command)
-                response_text = invoke_model(user_command)
-                specific_question = "Is this information correct? Please respond with 'Correct' or 'Incorrect'."
-                response_text += "\n" + specific_question
-                st.session_state.state = 3
-
-            # State 3: Validate result from state 1
-            elif st.session_state.state == 3:
-                if query.lower() in ["correct", "yes"]:
-                    response_text = "Please upload a word document, PDF, or link to the application."
-                    st.session_state.state = 4
-                elif query.lower() in ["incorrect", "no"]:
-                    response_text = "Please provide a short summary of the correct agency and program details."
-                    st.session_state.state = 7
-                else:
-                    response_text = f"Is the above information about {st.session_state.program_name} correct? Please respond with 'Correct' or 'Incorrect'. "
-                    st.session_state.state = 3
-
-            # state 4: Read and parse the file into questions
-            elif st.session_state.state == 4:
-                context = upload_file(file)
-                if context:
-                    query = f"We, BlocPower, need to respond to {st.session_state.program_name} program's request for proposal (RFP). Here's the context for application. Firstly, write a summary of the RFP. Secondly, read and parse the whole context, extract and list all the questions that blocpower needs to answer. "
-                    user_command = "Convert the second person pronoun 'you' in the question to the third person pronoun 'BlocPower'. List all converted questions and mark them with numbers at the beginning and a period at the end. "
-                    new_query = query + user_command + context
-                    response = invoke_model(new_query)
-                    st.session_state.response = response
-                    specific_question = "Is this question list complete? Please respond with 'Yes' or 'No'."
-                    response_text = specific_question + "\n" + response
-                    st.session_state.state = 5
-                    st.session_state.file_processed_4 = True
-                else:
-                    response_text = "No file content found. Please upload a valid file."
-
-            # state 5: check if the questions list is complete
-            elif st.session_state.state == 5:
-                if query.lower() in ["correct", "yes"]:
-                    st.session_state.question_list = extract_questions(
-                        st.session_state.response
-                    )
-                    specific_question = "I will start to answer the following questions. Enter 'Yes' to confirm, 'No' to cancel. "
-                    response_text = specific_question + str(
-                        st.session_state.question_list
-                    )
-                    st.session_state.chat_history.append(
-                        {
-                            "query": query,
-                            "response": response_text,
-                            "from_state_9": False,
-                        }
-                    )
-                    st.session_state.state = 9
-                elif query.lower() in ["incorrect", "no"]:
-                    response_text = "Please provide a list for all the questions."
-                    st.session_state.state = 8
-                else:
-                    response_text = "Is the question list complete? Please respond with 'Yes' or 'No'. "
-                    st.session_state.state = 5
-
-            # state 7: User provide information on program
-            elif st.session_state.state == 7:
-                user_command = f"The information you provided on {st.session_state.program_name} is not complete or correct. Here's the information provided by the user on the program: "
-                new_query = user_command + "\n" + query
-                # response_text, citations = invoke_agent(new_query)
-                response_text = invoke_model(new_query)
-                st.session_state.state = 3
-
-            # state 8: User provide complete questions list
-            elif st.session_state.state == 8:
-                user_command = "The question list you just extracted is not complete or correct. Here's the questions list provided by the user. Convert the second person pronoun 'you' in the question to the third person pronoun 'BlocPower'. List all converted questions and mark them with numbers."
-                new_query = user_command + query
-                response_text = invoke_model(new_query)
-                st.session_state.response = response_text
-                st.session_state.state = 5
-
-            # state 9: answer questions
-            elif st.session_state.state == 9:
-                st.session_state.last_state = 5
-                if query.lower() in ["yes"]:
-                    if len(st.session_state.question_list) == 0:
-                        response_text = "No Questions Detected. Ask me a question."
-                        st.session_state.chat_history.append(
-                            {
-                                "query": query,
-                                "response": response_text,
-                                "from_state_9": True,
-                            }
-                        )
-                        st.markdown(f"**You:** {query}")
-                        st.markdown(f"**Bot:** {response_text}")
-                        st.markdown("---")
-                    else:
-                        user_command = "Refer to the knowledge base and answer the following question with the first person 'we' instead of the third person 'Blocpower'."
-                        for question in st.session_state.question_list:
-                            new_question = user_command + question
-                            response_text, citations = invoke_agent(new_question)
-                            # Append current query and response to chat history
+
+def save_answer_library(library):
+    os.makedirs(ANSWER_LIBRARY_DIR, exist_ok=True)
+    library_path = os.path.join(ANSWER_LIBRARY_DIR, "library.npz")
+    # Entries and vectors share one file that is swapped in with a single rename
+    with tempfile.NamedTemporaryFile(
+        dir=ANSWER_LIBRARY_DIR, suffix=".tmp", delete=False
+    ) as f:
+        try:
+            np.savez(
+                f,
+                entries=np.array(json.dumps(library["entries"])),
+                vectors=library["vectors"],
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        except BaseException:
+            f.close()
+            os.unlink(f.name)
+            raise
+    try:
+        os.replace(f.name, library_path)
+    except OSError:
+        os.unlink(f.name)
+        raise
+
+
+@contextlib.contextmanager
+def answer_library_lock():
+    # A lock file created with O_EXCL works the same on every platform
+    os.makedirs(ANSWER_LIBRARY_DIR, exist_ok=True)
+    lock_path = os.path.join(ANSWER_LIBRARY_DIR, "library.lock")
+    deadline = time.time() + ANSWER_LIBRARY_LOCK_TIMEOUT
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > ANSWER_LIBRARY_LOCK_TIMEOUT:
+                    # Left behind by a session that crashed while saving
+                    os.remove(lock_path)
+                    continue
+            except FileNotFoundError:
+                continue
+            if time.time() > deadline:
+                raise TimeoutError(f"Timed out waiting for {lock_path}")
+            time.sleep(0.05)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.remove(lock_path)
+
+
+def find_exact_answer(library, question):
+    index = library["rows"].get(normalize_question(question))
+    if index is None:
+        return None
+    return library["entries"][index]
+
+
+@profiled("library lookup")
+def lookup_answer(library, question):
+    if not library["entries"]:
+        return None, 0.0
+    scores = library["vectors"] @ embed_question(question)
+    best = int(np.argmax(scores))
+    return best, float(scores[best])
+
+
+def add_to_answer_library(answers):
+    # Hold the lock across reload, append and save so concurrent approvals are not lost
+    with answer_library_lock():
+        library = load_answer_library()
+        rows = library["rows"]
+        vectors = list(library["vectors"])
+        for answer in answers:
+            key = normalize_question(answer["question"])
+            if key in rows:
+                # Replace the same question with the newer approved answer
+                library["entries"][rows[key]] = answer
+                vectors[rows[key]] = embed_question(answer["question"])
+            else:
+                rows[key] = len(library["entries"])
+                library["entries"].append(answer)
+                vectors.append(embed_question(answer["question"]))
+        if vectors:
+            library["vectors"] = np.stack(vectors)
+        save_answer_library(library)
+    return library
+
+
+# Streamlit UI
+st.set_page_config(page_title="AWS Bedrock Chatbot", page_icon=":robot_face:")
+start_rerun_profile()
+
+# Stop profiling even when the rerun is interrupted (st.stop, reruns, errors)
+try:
+    # Add logo
+    st.image("logo.png", width=200)  # Replace "logo.png" with your image file or URL
+
+    st.title("RFP Engine")
+
+
+    # Initialize session state for chat history
+    if "chat_history" not in st.session_state:
+        st.session_state.chat_history = []
+    if "state" not in st.session_state:
+        st.session_state.state = 1
+    if "last_state" not in st.session_state:
+        st.session_state.last_state = 0
+    if "question_list" not in st.session_state:
+        st.session_state.question_list = []
+    if "program_name" not in st.session_state:
+        st.session_state.program_name = ""
+    if "response" not in st.session_state:
+        st.session_state.response = ""
+    if "answer_library" not in st.session_state:
+        try:
+            st.session_state.answer_library = load_answer_library()
+        except ValueError as e:
+            st.error(f"Answer library could not be loaded: {e}")
+            st.session_state.answer_library = empty_answer_library()
+    if "pending_answers" not in st.session_state:
+        st.session_state.pending_answers = []
+
+    st.markdown(
+        """
+        **Enter your question/answer:**
+
+        - First, tell me the agency and the program hosting the RFP to which we need to respond.
+        - Then, follow up with any additional information or questions you have.
+        """
+    )
+
+    query = st.text_input("Your input:")
+    file = st.file_uploader(
+        f"Upload your document:", type=["pdf", "docx"], key="file_uploader"
+    )
+
+    if st.button("Submit", key="submit_query"):
+        if query or file:
+            with st.spinner("Processing..."):
+                response_text = ""
+                citations = []
+
+                with profile_stage("state dispatch"):
+                    # State 1: Provide information on progarm
+                    if st.session_state.state == 1:
+                        st.session_state.program_name = query
+                        user_command = f"Use Internet Search to provide information on {st.session_state.program_name}."
+                        # response_text, citations = invoke_agent(user_command)
+                        response_text = invoke_model(user_command)
+                        specific_question = "Is this information correct? Please respond with 'Correct' or 'Incorrect'."
+                        response_text += "\n" + specific_question
+                        st.session_state.state = 3
+
+                    # State 3: Validate result from state 1
+                    elif st.session_state.state == 3:
+                        if query.lower() in ["correct", "yes"]:
+                            response_text = "Please upload a word document, PDF, or link to the application."
+                            st.session_state.state = 4
+                        elif query.lower() in ["incorrect", "no"]:
+                            response_text = "Please provide a short summary of the correct agency and program details."
+                            st.session_state.state = 7
+                        else:
+                            response_text = f"Is the above information about {st.session_state.program_name} correct? Please respond with 'Correct' or 'Incorrect'. "
+                            st.session_state.state = 3
+
+                    # state 4: Read and parse the file into questions
+                    elif st.session_state.state == 4:
+                        context = upload_file(file)
+                        if context:
+                            query = f"We, BlocPower, need to respond to {st.session_state.program_name} program's request for proposal (RFP). Here's the context for application. Firstly, write a summary of the RFP. Secondly, read and parse the whole context, extract and list all the questions that blocpower needs to answer. "
+                            user_command = "Convert the second person pronoun 'you' in the question to the third person pronoun 'BlocPower'. List all converted questions and mark them with numbers at the beginning and a period at the end. "
+                            new_query = query + user_command + context
+                            response = invoke_model(new_query)
+                            st.session_state.response = response
+                            specific_question = "Is this question list complete? Please respond with 'Yes' or 'No'."
+                            response_text = specific_question + "\n" + response
+                            st.session_state.state = 5
+                            st.session_state.file_processed_4 = True
+                        else:
+                            response_text = "No file content found. Please upload a valid file."
+
+                    # state 5: check if the questions list is complete
+                    elif st.session_state.state == 5:
+                        if query.lower() in ["correct", "yes"]:
+                            st.session_state.question_list = extract_questions(
+                                st.session_state.response
+                            )
+                            specific_question = "I will start to answer the following questions. Enter 'Yes' to confirm, 'No' to cancel. "
+                            response_text = specific_question + str(
+                                st.session_state.question_list
+                            )
                             st.session_state.chat_history.append(
                                 {
-                                    "query": question,
+                                    "query": query,
+                                    "response": response_text,
+                                    "from_state_9": False,
+                                }
+                            )
+                            st.session_state.state = 9
+                        elif query.lower() in ["incorrect", "no"]:
+                            response_text = "Please provide a list for all the questions."
+                            st.session_state.state = 8
+                        else:
+                            response_text = "Is the question list complete? Please respond with 'Yes' or 'No'. "
+                            st.session_state.state = 5
+
+                    # state 7: User provide information on program
+                    elif st.session_state.state == 7:
+                        user_command = f"The information you provided on {st.session_state.program_name} is not complete or correct. Here's the information provided by the user on the program: "
+                        new_query = user_command + "\n" + query
+                        # response_text, citations = invoke_agent(new_query)
+                        response_text = invoke_model(new_query)
+                        st.session_state.state = 3
+
+                    # state 8: User provide complete questions list
+                    elif st.session_state.state == 8:
+                        user_command = "The question list you just extracted is not complete or correct. Here's the questions list provided by the user. Convert the second person pronoun 'you' in the question to the third person pronoun 'BlocPower'. List all converted questions and mark them with numbers."
+                        new_query = user_command + query
+                        response_text = invoke_model(new_query)
+                        st.session_state.response = response_text
+                        st.session_state.state = 5
+
+                    # state 9: answer questions
+                    elif st.session_state.state == 9:
+                        st.session_state.last_state = 5
+                        if query.lower() in ["yes"]:
+                            if len(st.session_state.question_list) == 0:
+                                response_text = "No Questions Detected. Ask me a question."
+                                st.session_state.chat_history.append(
+                                    {
+                                        "query": query,
+                                        "response": response_text,
+                                        "from_state_9": True,
+                                    }
+                                )
+                                st.markdown(f"**You:** {query}")
+                                st.markdown(f"**Bot:** {response_text}")
+                                st.markdown("---")
+                            else:
+                                user_command = "Refer to the knowledge base and answer the following question with the first person 'we' instead of the third person 'Blocpower'."
+                                reused_count = 0
+                                draft_count = 0
+                                for question in st.session_state.question_list:
+                                    st.markdown(f"**You:** {question}")
+                                    library = st.session_state.answer_library
+                                    entry = find_exact_answer(library, question)
+                                    if entry is not None:
+                                        # The same question was answered before, reuse it as is
+                                        response_text = entry["answer"]
+                                        reused_count += 1
+                                    else:
+                                        index, score = lookup_answer(library, question)
+                                        if index is not None and score >= ANSWER_DRAFT_THRESHOLD:
+                                            # Offer the closest approved answer while the agent runs
+                                            draft_count += 1
+                                            st.markdown(
+                                                f"**Draft from answer library** (similarity {score:.2f}): {library['entries'][index]['answer']}"
+                                            )
+                                        new_question = user_command + question
+                                        response_text, citations = invoke_agent(new_question)
+                                        if response_text != "Error invoking agent.":
+                                            st.session_state.pending_answers.append(
+                                                {
+                                                    "question": question,
+                                                    "answer": response_text,
+                                                    "program": st.session_state.program_name,
+                                                }
+                                            )
+                                    # Append current query and response to chat history
+                                    st.session_state.chat_history.append(
+                                        {
+                                            "query": question,
+                                            "response": response_text,
+                                            "from_state_9": True,
+                                        }
+                                    )
+                                    st.markdown(f"**Bot:** {response_text}")
+                                    st.markdown("---")
+                                question_count = len(st.session_state.question_list)
+                                response_text = f"Answer library: {reused_count} of {question_count} answers reused ({reused_count / question_count:.0%}), {draft_count} drafts offered, {reused_count} Bedrock calls avoided."
+                                st.session_state.chat_history.append(
+                                    {
+                                        "query": query,
+                                        "response": response_text,
+                                        "from_state_9": True,
+                                    }
+                                )
+                                st.markdown(f"**Bot:** {response_text}")
+                                st.markdown("---")
+                                st.session_state.question_list = []
+                            st.session_state.state = 10
+                            st.session_state.last_state = 9
+                            query = ""
+
+                        elif query.lower() in ["no"]:
+                            response_text = "Question answering canceled."
+                            st.session_state.chat_history.append(
+                                {
+                                    "query": query,
                                     "response": response_text,
                                     "from_state_9": True,
                                 }
                             )
-                            st.markdown(f"**You:** {question}")
+                            st.markdown(f"**You:** {query}")
                             st.markdown(f"**Bot:** {response_text}")
                             st.markdown("---")
-                        st.session_state.question_list = []
-                    st.session_state.state = 10
-                    st.session_state.last_state = 9
-                    query = ""
-
-                elif query.lower() in ["no"]:
-                    response_text = "Question answering canceled."
-                    st.session_state.chat_history.append(
-                        {
-                            "query": query,
-                            "response": response_text,
-                            "from_state_9": True,
-                        }
-                    )
-                    st.markdown(f"**You:** {query}")
-                    st.markdown(f"**Bot:** {response_text}")
-                    st.markdown("---")
-                    st.session_state.state = 10
-                    st.session_state.last_state = 9
-                    query = ""
-
-                else:
-                    response_text = (
-                        "Enter 'Yes' to start answer the questions, 'No' to cancel."
-                    )
-                    st.session_state.chat_history.append(
-                        {
-                            "query": query,
-                            "response": response_text,
-                            "from_state_9": True,
-                        }
-                    )
-                    st.markdown(f"**You:** {query}")
-                    st.markdown(f"**Bot:** {response_text}")
-                    st.markdown("---")
-                    st.session_state.last_state = 9
-
-            elif st.session_state.state == 10:
-                if file:
-                    context = upload_file(file)
-                    if context:
-                        user_command = "Based on the uploaded document, answer the following question with the first person 'we' instead of the third person 'Blocpower'."
-                        new_query = user_command + "\n" + query + " " + context
-                        claude_response = invoke_model(new_query)
-                        combined_query = f"The user asked: '{query}'. Claude's response was: '{claude_response}'. Please provide an enhanced answer considering the knowledge base."
-                        agent_response, citations = invoke_agent(combined_query)
-
-                        response_text = f"**Claude's Response:**\n{claude_response}\n\n**Agent's Enhanced Response:**\n{agent_response}"
-                    else:
-                        response_text = (
-                            "No file content found. Please upload a valid file."
+                            st.session_state.state = 10
+                            st.session_state.last_state = 9
+                            query = ""
+
+                        else:
+                            response_text = (
+                                "Enter 'Yes' to start answer the questions, 'No' to cancel."
+                            )
+                            st.session_state.chat_history.append(
+                                {
+                                    "query": query,
+                                    "response": response_text,
+                                    "from_state_9": True,
+                                }
+                            )
+                            st.markdown(f"**You:** {query}")
+                            st.markdown(f"**Bot:** {response_text}")
+                            st.markdown("---")
+                            st.session_state.last_state = 9
+
+                    elif st.session_state.state == 10:
+                        if file:
+                            context = upload_file(file)
+                            if context:
+                                user_command = "Based on the uploaded document, answer the following question with the first person 'we' instead of the third person 'Blocpower'."
+                                new_query = user_command + "\n" + query + " " + context
+                                claude_response = invoke_model(new_query)
+                                combined_query = f"The user asked: '{query}'. Claude's response was: '{claude_response}'. Please provide an enhanced answer considering the knowledge base."
+                                agent_response, citations = invoke_agent(combined_query)
+
+                                response_text = f"**Claude's Response:**\n{claude_response}\n\n**Agent's Enhanced Response:**\n{agent_response}"
+                            else:
+                                response_text = (
+                                    "No file content found. Please upload a valid file."
+                                )
+                        elif not file:
+                            user_command = "Answer the following question with the first person 'we' instead of the third person 'Blocpower'. "
+                            new_query = user_command + query
+                            response_text, citations = invoke_agent(new_query)
+
+                        st.session_state.last_state = 10
+
+                    if st.session_state.state != 9 and query:
+                        # Append current query and response to chat history
+                        st.session_state.chat_history.append(
+                            {"query": query, "response": response_text, "from_state_9": False}
                         )
-                elif not file:
-                    user_command = "Answer the following question with the first person 'we' instead of the third person 'Blocpower'. "
-                    new_query = user_command + query
-                    response_text, citations = invoke_agent(new_query)
 
-                st.session_state.last_state = 10
+                with profile_stage("render"):
+                    # Display chat history
+                    for chat in reversed(st.session_state.chat_history):
+                        if st.session_state.last_state == 9:
+                            if not chat.get("from_state_9", False):
+                                st.markdown(f"**You:** {chat['query']}")
+                                st.markdown(f"**Bot:** {chat['response']}")
+                                st.markdown("---")
+                        else:
+                            st.markdown(f"**You:** {chat['query']}")
+                            st.markdown(f"**Bot:** {chat['response']}")
+                            st.markdown("---")
 
-            if st.session_state.state != 9 and query:
-                # Append current query and response to chat history
-                st.session_state.chat_history.append(
-                    {"query": query, "response": response_text, "from_state_9": False}
+                    # Display citations in an expander below the chat history, if any
+                    if citations:
+                        with st.expander("Citations", expanded=False):
+                            for index, citation in enumerate(citations, start=1):
+                                text = citation["generatedResponsePart"]["textResponsePart"][
+                                    "text"
+                                ]
+                                st.markdown(f"\n{text}\n")
+                                for ref in citation["retrievedReferences"]:
+                                    content_text = ref["content"]["text"]
+                                    location_uri = ref["location"]["s3Location"]["uri"]
+                                    st.markdown(f"- [{content_text}]({location_uri})")
+                                if index < len(citations):
+                                    st.markdown("---")
+                    else:
+                        st.write("No citations available.")
+
+    # Approved answers from this session are added to the answer library for future RFPs
+    if st.session_state.pending_answers:
+        if st.button("Approve answers and save to library", key="save_answers"):
+            answer_count = len(st.session_state.pending_answers)
+            try:
+                st.session_state.answer_library = add_to_answer_library(
+                    st.session_state.pending_answers
                 )
-
-            # Display chat history
-            for chat in reversed(st.session_state.chat_history):
-                if st.session_state.last_state == 9:
-                    if not chat.get("from_state_9", False):
-                        st.markdown(f"**You:** {chat['query']}")
-                        st.markdown(f"**Bot:** {chat['response']}")
-                        st.markdown("---")
-                else:
-                    st.markdown(f"**You:** {chat['query']}")
-                    st.markdown(f"**Bot:** {chat['response']}")
-                    st.markdown("---")
-
-            # Display citations in an expander below the chat history, if any
-            if citations:
-                with st.expander("Citations", expanded=False):
-                    for index, citation in enumerate(citations, start=1):
-                        text = citation["generatedResponsePart"]["textResponsePart"][
-                            "text"
-                        ]
-                        st.markdown(f"\n{text}\n")
-                        for ref in citation["retrievedReferences"]:
-                            content_text = ref["content"]["text"]
-                            location_uri = ref["location"]["s3Location"]["uri"]
-                            st.markdown(f"- [{content_text}]({location_uri})")
-                        if index < len(citations):
-                            st.markdown("---")
-            else:
-                st.write("No citations available.")
+                st.session_state.pending_answers = []
+                st.success(f"Saved {answer_count} answers to the answer library.")
+            except (ValueError, OSError) as e:
+                st.error(f"Answer library could not be updated: {e}")
+finally:
+    finish_rerun_profile()